@@ -1,4 +1,9 @@
+import collections
+import concurrent.futures
+import functools
 import logging
+import logging.handlers
+import orjson
 import os
 import pathlib
 import queue
@@ -6,34 +11,172 @@ import shlex
 import signal
 import simpleaudio
 import threading
-import time
 import wave
 import zmq
 
 
-logging.basicConfig(level=logging.INFO,
+class ConsoleHandler(logging.StreamHandler):
+    """Writes both the log records and the input prompt, so they can't be
+    interleaved. While the user is being prompted, the prompt is written
+    again after each record, so it's always the last thing on screen."""
+    prompt = '> '
+
+    def __init__(self, stream=None):
+        super(ConsoleHandler, self).__init__(stream)
+        self.prompting = False
+
+    def show_prompt(self):
+        """Writes the prompt, unless it's already shown."""
+        self.acquire()
+        try:
+            if not self.prompting:
+                self.stream.write(self.prompt)
+                self.flush()
+                self.prompting = True
+        finally:
+            self.release()
+
+    def hide_prompt(self):
+        """Called once the user entered a line, which ends the prompt."""
+        self.acquire()
+        try:
+            self.prompting = False
+        finally:
+            self.release()
+
+    def emit(self, record):
+        # The lock is already held by handle()
+        if self.prompting:
+            self.stream.write('\r')  # Write the record over the prompt
+        super(ConsoleHandler, self).emit(record)
+        if self.prompting:
+            self.stream.write(self.prompt)
+            self.flush()
+
+
+console = ConsoleHandler()
+logging.basicConfig(level=logging.INFO, handlers=[console],
                     format='(%(threadName)s) %(levelname)s: %(message)s')
 
 SONGS_DIR = 'songs/'
-BUF_SIZE = 10
-q = queue.Queue(BUF_SIZE)
+SONGS_PATH = pathlib.Path(SONGS_DIR)
+CHUNK_SIZE = 128 * 1024  # 128 KB
+CREDITS = 8  # Max number of messages in flight during a download
+# Sent every half window of messages, serialized only once
+CREDIT_MESSAGE = orjson.dumps({'command': 'credit', 'args': CREDITS // 2})
+CANCEL_MESSAGE = orjson.dumps({'command': 'cancel', 'args': None})
+WRITE_BUF_SIZE = 8 * 1024 * 1024  # 8 MB
+DOWNLOAD_WORKERS = 4
+WAVE_CACHE_SIZE = 4  # Songs kept in memory after playing them (~40 MB each)
+# Table printed when a song starts playing (previous, current and next songs)
+SONGS_TABLE = (f"\n{'Previous' :<20}{'Current' :^20}{'Next' :>20}"
+               f"\n{'--------' :<20}{'--------' :^20}{'--------' :>20}"
+               "\n{:<20}{:^20}{:>20}")
+BUF_SIZE = 16  # Must be a power of two
+
+
+class SPSCRing:
+    """A bounded queue for a single producer and a single consumer.
+    Only the producer moves tail and only the consumer moves head,
+    so items are handed over without any lock. An event is set after
+    each put, so the consumer can sleep until there's something to get."""
+    __slots__ = ('buf', 'head', 'tail', 'mask', 'ready')
+
+    def __init__(self, size):
+        self.buf = [None] * size
+        self.head = 0
+        self.tail = 0
+        self.mask = size - 1
+        self.ready = threading.Event()
+
+    def put(self, item):
+        """Adds an item to the ring, returns False if it's full."""
+        if self.tail - self.head > self.mask:
+            return False
+        self.buf[self.tail & self.mask] = item
+        self.tail += 1
+        self.ready.set()
+        return True
+
+    def get(self):
+        """Removes and returns the oldest item, or None if the ring is empty."""
+        if self.head == self.tail:
+            return None
+        slot = self.head & self.mask
+        item = self.buf[slot]
+        self.buf[slot] = None
+        self.head += 1
+        return item
+
+    def wait(self):
+        """Blocks until an item is put in the ring (or ready is set).
+        Items put before this returns are still available with get()."""
+        self.ready.wait()
+        self.ready.clear()
+
+
+q = SPSCRing(BUF_SIZE)
+# Set by the 'exit' command, makes every thread stop
+stop_event = threading.Event()
+
+
+class LazyMessage:
+    """A log message that is only formatted when it's written."""
+    __slots__ = ('template', 'args')
+
+    def __init__(self, template, *args):
+        self.template = template
+        self.args = args
+
+    def __str__(self):
+        return self.template.format(*self.args)
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """Puts the records in the queue as they are, so their messages
+    are formatted by the listener thread instead of the calling one."""
+
+    def prepare(self, record):
+        return record
+
+
+def list_songs(directory=SONGS_DIR):
+    """Returns the names of the WAV files stored in directory."""
+    with os.scandir(directory) as entries:
+        return [entry.name for entry in entries
+                if entry.is_file() and entry.name.lower().endswith('.wav')]
+
+
+@functools.lru_cache(maxsize=WAVE_CACHE_SIZE)
+def load_wave(path):
+    """Reads a WAV file, keeping the most recently played ones in memory
+    so replaying them doesn't read and parse the file again."""
+    return simpleaudio.WaveObject.from_wave_file(path)
 
 
 class ClientThread(threading.Thread):
     def __init__(self, name):
-        super(ClientThread, self).__init__()
+        super(ClientThread, self).__init__(daemon=True)
         self.name = name
         self.socket = None
+        self.address = None
+        # Songs are downloaded in parallel, each worker thread uses its
+        # own socket (stored in worker) since they can't be shared
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=DOWNLOAD_WORKERS, thread_name_prefix='Download')
+        self.worker = threading.local()
+        # Names of the songs stored in SONGS_DIR, kept up to date by
+        # download() and delete() so they don't need to check the disk
+        self.local_songs = set(list_songs())
         self.playback_commands = {
             'play', 'stop', 'pause', 'resume', 'next', 'skip', 'prev', 'rm', 'info'
         }
 
     def run(self):
-        while True:
-            time.sleep(0.3)
+        while not stop_event.is_set():
             try:
                 # shlex is used to also split quoted inputs
-                user_input = shlex.split(input("> "))
+                user_input = shlex.split(self.read_line())
             except Exception as e:
                 logging.error(e)
                 continue
@@ -67,7 +210,8 @@ class ClientThread(threading.Thread):
                     self.put_instruction(command, args)
 
                 elif command == 'exit':
-                    signal.raise_signal(signal.SIGINT)
+                    stop_event.set()
+                    q.ready.set()  # Wake up the player so it stops
 
                 else:
                     logging.warning(f"Command '{command}' not supported")
@@ -80,16 +224,40 @@ class ClientThread(threading.Thread):
             except Exception as e:
                 logging.error(e)
 
+    def read_line(self):
+        """Returns the next line entered by the user,
+        or 'exit' once stdin is closed."""
+        # The prompt is written by the logging handler, so
+        # it's written again after any log record
+        console.show_prompt()
+        try:
+            return input()
+        except EOFError:
+            return 'exit'
+        finally:
+            console.hide_prompt()
+
     def connect(self, ip):
         """Connects the client to the server using its ip address."""
-        context = zmq.Context()
-        self.socket = context.socket(zmq.REQ)
-        self.socket.connect(f'tcp://{ip}:5555')
+        self.address = f'tcp://{ip}:5555'
+        self.socket = self.new_socket()
+
+    def new_socket(self):
+        """Returns a new socket connected to the server."""
+        # The context (and its IO thread) is shared by the whole process
+        socket = zmq.Context.instance().socket(zmq.DEALER)
+        # Don't wait for unsent messages on close, and allow
+        # a full window of chunks to be queued when receiving
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.setsockopt(zmq.RCVHWM, 64)
+        socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+        socket.connect(self.address)
+        return socket
 
     def search(self, command, args):
         """Lists all the files stored in the server, if no query is given."""
-        self.socket.send_json({'command': command, 'args': args})
-        reply = self.socket.recv_json()
+        self.socket.send(orjson.dumps({'command': command, 'args': args}))
+        reply = orjson.loads(self.socket.recv())
         if reply['files']:
             print(*reply['files'], sep='\n')
         else:
@@ -97,67 +265,146 @@ class ClientThread(threading.Thread):
 
     def list_local(self):
         """Lists all the local files that are stores in the songs directory."""
-        files = os.listdir(SONGS_DIR)
-        print(*files, sep='\n')
+        print(*list_songs(), sep='\n')
 
     def download(self, args):
         """Returns a list containing all the available songs, which are the
         ones that were successfully downloaded or are already downloaded."""
-        new_args = []
+        missing = []
         for filename in args:
             # First check if it's already downloaded
-            if os.path.exists(f"{SONGS_DIR}{filename}"):
-                new_args.append(filename)
+            if filename in self.local_songs or (SONGS_PATH / filename).exists():
+                self.local_songs.add(filename)
                 logging.debug(f"'{filename}' already downloaded")
-                continue
+            elif filename not in missing:
+                missing.append(filename)
+
+        # Split the missing songs in batches, one per worker
+        workers = min(DOWNLOAD_WORKERS, len(missing))
+        downloads = {self.executor.submit(self.download_songs, batch): batch
+                     for batch in (missing[i::workers] for i in range(workers))}
+        # Wait for every worker, even if some of them fail
+        concurrent.futures.wait(downloads)
+        for download, batch in downloads.items():
+            if error := download.exception():
+                logging.error(error)
+                # The songs of the batch that were completed before the
+                # error are kept, the one being written was deleted
+                self.local_songs.update(
+                    filename for filename in batch
+                    if (SONGS_PATH / filename).exists())
+            else:
+                self.local_songs.update(download.result())
+
+        return [filename for filename in args if filename in self.local_songs]
+
+    def download_songs(self, filenames):
+        """Downloads a batch of songs from the server with a single request,
+        using the socket of the worker thread. Returns the list of songs
+        that were downloaded."""
+        if not hasattr(self.worker, 'socket'):
+            self.worker.socket = self.new_socket()
+        socket = self.worker.socket
+
+        # The server sends the songs in order, in messages made of several
+        # chunks, each song ending with an empty chunk. It can send up to
+        # CREDITS messages before waiting for more credits
+        socket.send(orjson.dumps({'command': 'down', 'args': filenames,
+                                  'chunk_size': CHUNK_SIZE, 'credits': CREDITS}))
+        messages = self.receive_messages(socket)
+        downloaded = []
+        writing = None  # Song whose file is being written
+        try:
+            for filename in filenames:
+                # Check if the first chunk is not empty
+                if not (chunks := next(messages))[0]:
+                    logging.warning(f"'{filename}' not found or it's empty")
+                    continue
 
-            # Download the song from the server
-            self.socket.send_json({'command': 'down', 'args': filename})
-            # Check if the first chunk is not empty
-            if data := self.socket.recv():
                 logging.debug(f"Downloading '{filename}'...")
-                with open(f'{SONGS_DIR}{filename}', 'ab') as file:
-                    file.write(data)  # Write the first chunk
-                    self.socket.send_string('ok')
-                    # Receive chunks until not empty
-                    while data := self.socket.recv():
-                        file.write(data)
-                        self.socket.send_string('ok')
-
-                new_args.append(filename)
+                writing = filename
+                with open(SONGS_PATH / filename, 'ab',
+                          buffering=WRITE_BUF_SIZE) as file:
+                    file.writelines(chunks)
+                    # Receive messages until the last chunk is empty
+                    while chunks[-1]:
+                        chunks = next(messages)
+                        file.writelines(chunks)
+
+                writing = None
+                downloaded.append(filename)
                 logging.debug(f"'{filename}' downloaded")
-            else:
-                logging.warning(f"'{filename}' not found or it's empty")
-
-        return new_args
+        except Exception:
+            # Don't leave an incomplete song, it would be taken as downloaded
+            if writing:
+                (SONGS_PATH / writing).unlink(missing_ok=True)
+
+            # Tell the server to stop sending the rest of the batch. It may
+            # still send some messages, so the next request must use a new
+            # socket (which gets a new identity)
+            try:
+                socket.send(CANCEL_MESSAGE, zmq.NOBLOCK)
+            except zmq.Again:
+                pass  # Not connected to the server
+            # Give the cancel message some time to be sent after closing
+            socket.close(linger=1000)
+            del self.worker.socket
+            raise
+
+        return downloaded
+
+    def receive_messages(self, socket):
+        """Yields the chunks of each message sent by the server, granting
+        it new credits every half window."""
+        received = 0
+        while True:
+            # Chunks are received as zero-copy frames, their
+            # buffers can be written directly to the files
+            chunks = [frame.buffer for frame in socket.recv_multipart(copy=False)]
+            received += 1
+            if received % (CREDITS // 2) == 0:
+                socket.send(CREDIT_MESSAGE)
+            yield chunks
 
     def delete(self, args):
         """Deletes all the songs listed in args."""
         for filename in args:
             try:
-                os.remove(f"{SONGS_DIR}{filename}")
+                self.local_songs.discard(filename)
+                (SONGS_PATH / filename).unlink()
                 logging.debug(f"'{filename}' deleted")
             except OSError:
                 logging.error(f"Can't delete '{filename}', not found")
 
+        # Don't play the deleted songs from memory (lru_cache
+        # doesn't allow to discard single entries)
+        load_wave.cache_clear()
+
     def put_instruction(self, command, args):
         """Puts an instruction in the queue,
         which has a command and a list of args."""
         if command == 'play' and args:
             args = self.download(args)
             if not args:
+                logging.info(f"Type the name of the songs from '{SONGS_DIR}', "
+                             "or download them from the server using 'add'")
                 return
 
         playback_instruction = {'command': command, 'args': args}
-        q.put(playback_instruction)
+        if not q.put(playback_instruction):
+            logging.warning("The player is busy, try again")
 
 
 class PlayerThread(threading.Thread):
     def __init__(self, name):
-        super(PlayerThread, self).__init__()
+        super(PlayerThread, self).__init__(daemon=True)
         self.name = name
         self.playlist = []
+        # Number of times each song is in the playlist
+        self.playlist_count = collections.Counter()
         self.temp_playlist = []
+        # The playlist that is being played, see update_active_playlist()
+        self.active_playlist = self.playlist
         self.playlist_info = False
         self.playlist_end = False
         self.playback_thread = None
@@ -170,42 +417,51 @@ class PlayerThread(threading.Thread):
         self.paused = False
 
     def run(self):
-        while True:
-            if not q.empty():
-                instruction = q.get()
-                command = instruction['command']
-                args = instruction['args']
-
-                if command == 'add':
-                    self.add(args)
-
-                elif command == 'play':
-                    if self.paused:
-                        self.resume_song()  # Using play to unpause a song
-                        continue
-
-                    self.play(args)
-
-                elif command == 'stop':
-                    self.stop()
-                elif command == 'pause':
-                    self.pause_song()
-                elif command == 'resume':
-                    self.resume_song()
-                elif command == 'prev':
-                    self.switch_song(-1)
-                elif command in ('next', 'skip'):
-                    self.switch_song(1)
-                elif command in ('del', 'rm'):
-                    self.remove(args)
-                elif command == 'info':
-                    self.print_playlist()
-                    logging.debug(f"Current song: {self.song_name}")
+        while not stop_event.is_set():
+            # Sleep until the client puts new instructions (or exits)
+            q.wait()
+            self.handle_instructions()
+
+        # Handle the instructions put right before 'exit'
+        self.handle_instructions()
+
+    def handle_instructions(self):
+        """Handles all the instructions in the queue."""
+        while (instruction := q.get()) is not None:
+            command = instruction['command']
+            args = instruction['args']
+
+            if command == 'add':
+                self.add(args)
+
+            elif command == 'play':
+                if self.paused:
+                    self.resume_song()  # Using play to unpause a song
+                    continue
+
+                self.play(args)
+
+            elif command == 'stop':
+                self.stop()
+            elif command == 'pause':
+                self.pause_song()
+            elif command == 'resume':
+                self.resume_song()
+            elif command == 'prev':
+                self.switch_song(-1)
+            elif command in ('next', 'skip'):
+                self.switch_song(1)
+            elif command in ('del', 'rm'):
+                self.remove(args)
+            elif command == 'info':
+                self.print_playlist()
+                logging.debug(f"Current song: {self.song_name}")
 
     def add(self, args):
         """Adds the songs listed in args to the playlist."""
         for filename in args:
             self.playlist.append(filename)
+            self.playlist_count[filename] += 1
             logging.debug(f"'{filename}' added to playlist")
         self.print_playlist()
 
@@ -215,16 +471,11 @@ class PlayerThread(threading.Thread):
             return
 
         if args:
-            # A lambda function that checks if the filename exists
-            def f(x): return True if os.path.exists(
-                f"{SONGS_DIR}{x}") else logging.warning(f"'{x}' not found")
             # The temp playlist is created only once, when this
-            # function is called from run() with a list of songs
-            self.temp_playlist = [file for file in args if f(file)]
-            if not self.temp_playlist:
-                logging.info(f"Type the name of the songs from '{SONGS_DIR}', "
-                             "or download them from the server using 'add'")
-                return
+            # function is called from run() with a list of songs.
+            # The client already checked that they are downloaded
+            self.temp_playlist = list(args)
+            self.update_active_playlist()
 
         if not self.playlist and not self.temp_playlist:
             logging.info("Add songs to the playlist using 'add', or use "
@@ -237,7 +488,7 @@ class PlayerThread(threading.Thread):
             self.playlist_info = True
 
         self.playback_thread = threading.Thread(
-            target=self.play_all, name='Playback')
+            target=self.play_all, name='Playback', daemon=True)
         self.stopped = False
         self.playlist_end = False
         self.thread_running = True
@@ -246,24 +497,26 @@ class PlayerThread(threading.Thread):
     def play_all(self):
         """Plays all the songs in playlist starting from index.
         If temp_playlist is not empty, will play its songs instead."""
+        # The methods are looked up only once, the attributes are read on
+        # every iteration because the Player thread changes them
+        play_song = self.play_song
+        valid_index = self.valid_index
         while not self.playlist_end:
             self.update_index = True
             if self.stopped:
                 break
 
-            if self.temp_playlist:
-                self.play_song(self.temp_playlist[self.index])
-            else:
-                self.play_song(self.playlist[self.index])
+            play_song(self.active_playlist[self.index])
 
             if self.update_index and not self.stopped:
                 # Only increment index when a song stops playing on its own
-                if self.valid_index(1):  # If the next index is valid
+                if valid_index(1):  # If the next index is valid
                     self.index += 1
                 else:
                     # Reset index and temp list once the last song stops playing
                     self.index = 0
                     self.temp_playlist = []
+                    self.update_active_playlist()
                     self.playlist_info = False
                     self.playlist_end = True
 
@@ -273,8 +526,8 @@ class PlayerThread(threading.Thread):
         """Plays a song given its filename, and checks if the
         playlist will reach its end, after the song ends"""
         try:
-            wave_obj = simpleaudio.WaveObject.from_wave_file(
-                f"{SONGS_DIR}{filename}")
+            # wave only opens paths given as str
+            wave_obj = load_wave(str(SONGS_PATH / filename))
             self.song_name = filename
             self.current_song = wave_obj.play()
             self.print_songs()
@@ -285,20 +538,22 @@ class PlayerThread(threading.Thread):
             self.remove_song(filename)
         except wave.Error as e:
             logging.error(f"{e}, file extension must be '.wav'")
-            self.remove(filename)
+            self.remove_song(filename)
         except EOFError:
             logging.error(f"'{filename}' is empty")
-            self.remove(filename)
+            self.remove_song(filename)
         finally:
             self.song_name = self.current_song = None
 
     def valid_index(self, amount):
         """Checks whether the next (or previous) index
         of the current playlist is valid or not."""
-        if self.temp_playlist:
-            return True if 0 <= self.index + amount < len(self.temp_playlist) else False
-        else:
-            return True if 0 <= self.index + amount < len(self.playlist) else False
+        return 0 <= self.index + amount < len(self.active_playlist)
+
+    def update_active_playlist(self):
+        """Updates active_playlist, which is temp_playlist if it's not empty.
+        Must be called every time one of the playlists is replaced."""
+        self.active_playlist = self.temp_playlist or self.playlist
 
     def stop(self, reset=True):
         """Stops whichever song is currently playing."""
@@ -317,6 +572,7 @@ class PlayerThread(threading.Thread):
         if reset:
             self.index = 0
             self.temp_playlist = []
+            self.update_active_playlist()
             self.playlist_info = False
 
     def pause_song(self):
@@ -354,16 +610,14 @@ class PlayerThread(threading.Thread):
         self.play()
 
     def print_playlist(self):
-        playlist = self.temp_playlist if self.temp_playlist else self.playlist
-        logging.info(f"Playlist: {playlist}")
+        logging.info(f"Playlist: {self.active_playlist}")
 
     def print_songs(self):
-        playlist = self.temp_playlist if self.temp_playlist else self.playlist
+        playlist = self.active_playlist
         prev = playlist[self.index - 1] if self.valid_index(-1) else '-'
         next_ = playlist[self.index + 1] if self.valid_index(1) else '-'
-        logging.info(f"\n{'Previous' :<20}{'Current' :^20}{'Next' :>20}"
-                     f"\n{'--------' :<20}{'--------' :^20}{'--------' :>20}"
-                     f"\n{prev :<20}{self.song_name :^20}{next_ :>20}")
+        # Formatted by the logging thread, not while the song starts
+        logging.info(LazyMessage(SONGS_TABLE, prev, self.song_name, next_))
 
     def remove(self, args):
         """Removes all the songs in args from the playlist."""
@@ -371,19 +625,41 @@ class PlayerThread(threading.Thread):
             logging.warning("Provide the name of the songs to")
             return
 
-        for filename in args:
-            self.remove_song(filename)
+        self.remove_songs(args)
         self.print_playlist()
 
     def remove_song(self, filename):
         """Removes only a song from the playlist."""
-        try:
-            rm_index = self.playlist.index(filename)
-            name = self.playlist.pop(rm_index)
-            self.fix_index(rm_index)
-            logging.debug(f"'{name}' removed from the playlist")
-        except ValueError:
-            logging.warning(f"'{filename}' not in playlist")
+        self.remove_songs([filename])
+
+    def remove_songs(self, filenames):
+        """Removes the first occurrence of each song in filenames from the
+        playlist, going through it only once for all of them."""
+        pending = collections.Counter()
+        for filename in filenames:
+            # The counts tell whether a song is in the playlist without
+            # searching for it
+            if self.playlist_count[filename] > pending[filename]:
+                pending[filename] += 1
+            else:
+                logging.warning(f"'{filename}' not in playlist")
+
+        if not pending:
+            return
+
+        self.playlist_count -= pending
+        playlist = []
+        for name in self.playlist:
+            if pending[name]:
+                pending[name] -= 1
+                # Songs before this one were already removed, so its
+                # index is the current length of the new playlist
+                self.fix_index(len(playlist))
+                logging.debug(f"'{name}' removed from the playlist")
+            else:
+                playlist.append(name)
+        self.playlist = playlist
+        self.update_active_playlist()
 
     def fix_index(self, rm_index):
         """Fixes the playlist's index when a song is removed from it"""
@@ -396,8 +672,22 @@ class PlayerThread(threading.Thread):
             self.update_index = False
 
 
+def setup_logging():
+    """Moves the root logger handlers to a listener thread, so log records
+    from every thread are formatted and written one at a time, off the
+    calling thread. Returns the listener, which must be stopped on exit."""
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    listener = logging.handlers.QueueListener(
+        log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [RecordQueueHandler(log_queue)]
+    listener.start()
+    return listener
+
+
 def main():
     pathlib.Path(SONGS_DIR).mkdir(exist_ok=True)
+    listener = setup_logging()
 
     client = ClientThread(name='Client')
     player = PlayerThread(name='Player')
@@ -405,12 +695,19 @@ def main():
     client.connect("localhost")
 
     # Add local songs to the playlist
-    player.add(os.listdir(SONGS_DIR))
+    player.add(list_songs())
 
     signal.signal(signal.SIGINT, signal.SIG_DFL)
 
-    client.start()
     player.start()
+    client.start()
+
+    # The player handles the instructions it already got before stopping,
+    # the rest of the threads are daemons, so they end with the main thread
+    stop_event.wait()
+    player.join()
+    simpleaudio.stop_all()
+    listener.stop()  # Write the remaining log records
 
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 import logging
+import orjson
 import os
 import pathlib
 import signal
@@ -10,10 +11,15 @@ logging.basicConfig(level=logging.INFO,
 
 SRV_DIR = 'server_files/'
 CHUNK_SIZE = 1024 * 1024 * 10  # 10 MB
+MIN_CHUNK_SIZE = 4 * 1024  # 4 KB
+MESSAGE_SIZE = 1024 * 1024 * 2  # 2 MB, chunks are grouped up to this size
 
 
 def list_files(query, directory=SRV_DIR):
-    files = os.listdir(directory)
+    # Names that aren't valid UTF-8 are listed with the invalid bytes
+    # replaced, since they can't be serialized (orjson rejects surrogates)
+    files = [file.encode('utf-8', 'surrogateescape').decode('utf-8', 'replace')
+             for file in os.listdir(directory)]
     if query:
         # Only keep the files that match the query
         files = [file for file in files if query[0].lower() in file.lower()]
@@ -21,47 +27,111 @@ def list_files(query, directory=SRV_DIR):
     return files
 
 
-def send_file(socket, filename, directory=SRV_DIR):
+def read_messages(filename, chunk_size=CHUNK_SIZE, directory=SRV_DIR):
+    """Yields the messages of a file, lists of chunks that add up to about
+    MESSAGE_SIZE. The last chunk of the last message is empty, marking the
+    end of the file (it's the only one sent when the file is not found).
+    The chunks are only valid until the next message is read."""
     path = f'{directory}{filename}'
+    chunks = []
     if os.path.exists(path):
         logging.debug(f"Sending '{filename}'...")
-        with open(path, 'rb') as file:
+        # Chunks are read into the same buffers for every message, which
+        # can be reused because the socket copies the data when sending it
+        buffers = [memoryview(bytearray(chunk_size))
+                   for _ in range(max(1, MESSAGE_SIZE // chunk_size))]
+        with open(path, 'rb', buffering=0) as file:
             # Read chunks while not empty
-            while data := file.read(CHUNK_SIZE):
-                socket.send(data)
-                if socket.recv_string() != 'ok':
-                    break
-            else:
-                logging.debug(f"'{filename}' sent")
+            while size := file.readinto(buffer := buffers[len(chunks)]):
+                chunks.append(buffer[:size])
+                if len(chunks) == len(buffers):
+                    yield chunks
+                    chunks = []
+        logging.debug(f"'{filename}' sent")
+
+    chunks.append(b'')
+    yield chunks
+
+
+def read_files(filenames, chunk_size=CHUNK_SIZE, directory=SRV_DIR):
+    """Yields the messages of every file, one file after the other."""
+    for filename in filenames:
+        yield from read_messages(filename, chunk_size, directory)
+
 
-    socket.send(b'')  # Sent when not found or as the last reply
+def send_messages(socket, transfers):
+    """Sends the next message of every transfer whose client has credits
+    left. Clients grant credits as they write the messages, so several
+    messages are in flight instead of waiting for an acknowledgement
+    after each one."""
+    for identity, transfer in list(transfers.items()):
+        if transfer['credits'] <= 0:
+            continue
+
+        chunks = next(transfer['messages'])
+        socket.send_multipart([identity, *chunks])
+        transfer['credits'] -= 1
+        if not chunks[-1]:
+            transfer['files'] -= 1
+            if not transfer['files']:
+                del transfers[identity]  # Last message was sent
 
 
 def main():
     pathlib.Path(SRV_DIR).mkdir(exist_ok=True)
 
     context = zmq.Context()
-    socket = context.socket(zmq.REP)
+    socket = context.socket(zmq.ROUTER)
     socket.bind('tcp://*:5555')
     logging.info('Server is listening ...')
 
+    # Downloads in progress, by client identity
+    transfers = {}
+
     while True:
         signal.signal(signal.SIGINT, signal.SIG_DFL)
 
-        message = socket.recv_json()
-        logging.info(f"Request = {message}")
-        command = message['command']
-        args = message['args']
+        # Only block waiting for requests when there are no messages to send
+        sending = any(t['credits'] > 0 for t in transfers.values())
+        if socket.poll(0 if sending else None):
+            identity, request = socket.recv_multipart()
+            message = orjson.loads(request)
+            command = message['command']
+            args = message['args']
+
+            if command == 'credit':
+                if identity in transfers:
+                    transfers[identity]['credits'] += args
+
+            elif command == 'cancel':
+                # The client gave up on its download, so stop reading
+                # (and close) its files
+                logging.info(f"Request = {message}")
+                if transfer := transfers.pop(identity, None):
+                    transfer['messages'].close()
+
+            elif command == 'search':
+                logging.info(f"Request = {message}")
+                reply = list_files(query=args)
+                socket.send_multipart(
+                    [identity, orjson.dumps({'files': reply})])
+
+            elif command == 'down':
+                logging.info(f"Request = {message}")
+                # Use the chunk size requested by the client,
+                # between MIN_CHUNK_SIZE and CHUNK_SIZE
+                chunk_size = message.get('chunk_size', CHUNK_SIZE)
+                chunk_size = max(MIN_CHUNK_SIZE, min(chunk_size, CHUNK_SIZE))
+                transfers[identity] = {
+                    'messages': read_files(filenames=args, chunk_size=chunk_size),
+                    'credits': message.get('credits', 1),
+                    'files': len(args)
+                }
 
-        if command == 'search':
-            reply = list_files(query=args)
-            socket.send_json({'files': reply})
-
-        elif command == 'down':
-            send_file(socket, filename=args)
+            else:
+                logging.warning(f"Command '{command}' not supported")
 
-        else:
-            logging.warning(f"Command '{command}' not supported")
+        send_messages(socket, transfers)
 
 
 if __name__ == '__main__':